@@ -1,8 +1,13 @@
-import json
 import logging
 import os
-from azure.cosmos import CosmosClient, exceptions
-from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
+import re
+from functools import lru_cache
+import aiohttp
+import orjson
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos import exceptions
+from azure.cosmos.aio import CosmosClient
+from azure.identity.aio import DefaultAzureCredential, ManagedIdentityCredential
 import azure.functions as func
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
@@ -12,67 +17,152 @@ COSMOS_ENDPOINT = os.environ.get("COSMOS_ENDPOINT", "")
 COSMOS_CLIENT_ID = os.environ.get("AZURE_CLIENT_ID", "")  # User-assigned managed identity client ID
 
 
+def _env_number(name: str, default, cast=int):
+    """Read a numeric app setting, falling back to the default if it is missing or malformed."""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        logging.warning(f"Invalid value {value!r} for {name}; using default {default}")
+        return default
+
+
+# HTTP connection pool tuning for the Cosmos transport
+COSMOS_MAX_CONN_PER_HOST = _env_number("COSMOS_MAX_CONN_PER_HOST", 10)
+COSMOS_KEEPALIVE = _env_number("COSMOS_KEEPALIVE", 60.0, float)  # Seconds an idle connection is kept open
+# Seconds to wait for a TCP/TLS connection to be established; the SDK default is 60
+COSMOS_CONNECT_TIMEOUT = _env_number("COSMOS_CONNECT_TIMEOUT", 6)
+# Opt-in for accounts configured with multi-region writes; changes write routing and conflict behaviour
+COSMOS_MULTIPLE_WRITE_LOCATIONS = os.environ.get("COSMOS_MULTIPLE_WRITE_LOCATIONS", "").lower() == "true"
+# Comma-separated regions (e.g. "West US 2,East US") the SDK should try first for reads and writes
+COSMOS_PREFERRED_LOCATIONS = [
+    location.strip()
+    for location in os.environ.get("COSMOS_PREFERRED_LOCATIONS", "").split(",")
+    if location.strip()
+]
+
+# Maximum number of items returned by a single query_items call; callers page with the continuation token
+QUERY_PAGE_SIZE = 1000
+
+# Query shapes the SDK evaluates client-side across partitions. Their continuation tokens only
+# reflect the last partition read, so they cannot be handed back to callers for resuming.
+# Keywords must stand alone: property names such as c.topic or c.offset do not count.
+PIPELINED_QUERY_PATTERN = re.compile(
+    r"(?<![.\w])(ORDER\s+BY|DISTINCT|GROUP\s+BY|TOP|OFFSET)\b"
+    r"|(?<![.\w])(COUNT|COUNTIF|SUM|AVG|MIN|MAX|MAKESET|MAKELIST)\s*\(",
+    re.IGNORECASE,
+)
+# Single- or double-quoted string literals, removed before looking for keywords
+QUOTED_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+
+
+def _is_pipelined_query(query: str) -> bool:
+    """Return True if the query uses a shape whose continuation tokens cannot be resumed."""
+    return PIPELINED_QUERY_PATTERN.search(QUOTED_LITERAL_PATTERN.sub("''", query)) is not None
+
+
+def _dumps(obj) -> str:
+    """Serialize an object to a JSON string using orjson."""
+    return orjson.dumps(obj).decode()
+
+
+# Use ManagedIdentityCredential with specific client ID if provided, otherwise DefaultAzureCredential.
+# Built once per worker so its token cache is shared by every invocation.
+if COSMOS_CLIENT_ID:
+    _credential = ManagedIdentityCredential(client_id=COSMOS_CLIENT_ID)
+else:
+    _credential = DefaultAzureCredential()
+
+_session = None
+_client = None
+
+
 def get_cosmos_client():
-    """Get a CosmosDB client instance using Managed Identity."""
+    """Get the shared async CosmosDB client instance using Managed Identity.
+
+    The client and its aiohttp session are created on first use and reused for the
+    lifetime of the worker process, so pooled connections and metadata caches survive
+    across invocations. All handlers run on the worker's single event loop, and nothing
+    here awaits, so no lock is needed around the lazy initialization.
+    """
+    global _session, _client
+    if _client is not None:
+        return _client
+
     if not COSMOS_ENDPOINT:
         raise ValueError("COSMOS_ENDPOINT environment variable must be set")
-    
-    # Use ManagedIdentityCredential with specific client ID if provided, otherwise DefaultAzureCredential
-    if COSMOS_CLIENT_ID:
-        credential = ManagedIdentityCredential(client_id=COSMOS_CLIENT_ID)
-    else:
-        credential = DefaultAzureCredential()
-    
-    return CosmosClient(COSMOS_ENDPOINT, credential=credential)
-
-
-class ToolProperty:
-    """Helper class to define MCP tool properties."""
-    def __init__(self, property_name: str, property_type: str, description: str, required: bool = True):
-        self.propertyName = property_name
-        self.propertyType = property_type
-        self.description = description
-        self.required = required
-
-    def to_dict(self):
-        return {
-            "propertyName": self.propertyName,
-            "propertyType": self.propertyType,
-            "description": self.description,
-        }
+
+    # The session must be created inside the running event loop, hence lazily here
+    _session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=COSMOS_MAX_CONN_PER_HOST,
+            keepalive_timeout=COSMOS_KEEPALIVE,
+        )
+    )
+    transport = AioHttpTransport(session=_session, session_owner=False)
+    # The Python SDK only supports Gateway mode, so there is no Direct/TCP connection mode to opt into.
+    # connection_timeout only bounds connection setup (the transport applies it as the socket connect
+    # timeout, not to reads), so a short value lets an unreachable endpoint fail fast instead of
+    # holding an invocation for 60s.
+    _client = CosmosClient(
+        COSMOS_ENDPOINT,
+        credential=_credential,
+        transport=transport,
+        multiple_write_locations=COSMOS_MULTIPLE_WRITE_LOCATIONS,
+        preferred_locations=COSMOS_PREFERRED_LOCATIONS,
+        connection_timeout=COSMOS_CONNECT_TIMEOUT,
+    )
+    return _client
+
+
+@lru_cache(maxsize=128)
+def get_container_client(database_name: str, container_name: str):
+    """Get a cached container client for the given database and container.
+
+    Names come from the caller and are not validated, so the cache is bounded to keep
+    mistyped or nonexistent names from accumulating for the life of the worker.
+    """
+    database = get_cosmos_client().get_database_client(database_name)
+    return database.get_container_client(container_name)
 
 
 # Define tool properties for each CosmosDB operation
-list_databases_properties = json.dumps([])
+list_databases_properties = _dumps([])
 
-list_containers_properties = json.dumps([
-    ToolProperty("database_name", "string", "The name of the database to list containers from.").to_dict()
+list_containers_properties = _dumps([
+    {"propertyName": "database_name", "propertyType": "string", "description": "The name of the database to list containers from."},
 ])
 
-query_items_properties = json.dumps([
-    ToolProperty("database_name", "string", "The name of the database.").to_dict(),
-    ToolProperty("container_name", "string", "The name of the container to query.").to_dict(),
-    ToolProperty("query", "string", "The SQL query to execute (e.g., 'SELECT * FROM c WHERE c.category = \"electronics\"').").to_dict(),
+query_items_properties = _dumps([
+    {"propertyName": "database_name", "propertyType": "string", "description": "The name of the database."},
+    {"propertyName": "container_name", "propertyType": "string", "description": "The name of the container to query."},
+    {"propertyName": "query", "propertyType": "string", "description": "The SQL query to execute (e.g., 'SELECT * FROM c WHERE c.category = \"electronics\"')."},
+    {"propertyName": "continuation_token", "propertyType": "string", "description": "Optional. The continuation token returned by a previous call, to fetch the next page of results. Not supported for queries using ORDER BY, DISTINCT, GROUP BY, TOP, OFFSET/LIMIT or aggregate functions."},
+    {"propertyName": "max_items", "propertyType": "integer", "description": "Optional. The maximum number of items to return in this page (1-1000). Defaults to 1000."},
 ])
 
-get_item_properties = json.dumps([
-    ToolProperty("database_name", "string", "The name of the database.").to_dict(),
-    ToolProperty("container_name", "string", "The name of the container.").to_dict(),
-    ToolProperty("item_id", "string", "The ID of the item to retrieve.").to_dict(),
-    ToolProperty("partition_key", "string", "The partition key value for the item.").to_dict(),
+get_item_properties = _dumps([
+    {"propertyName": "database_name", "propertyType": "string", "description": "The name of the database."},
+    {"propertyName": "container_name", "propertyType": "string", "description": "The name of the container."},
+    {"propertyName": "item_id", "propertyType": "string", "description": "The ID of the item to retrieve."},
+    {"propertyName": "partition_key", "propertyType": "string", "description": "The partition key value for the item."},
 ])
 
-delete_item_properties = json.dumps([
-    ToolProperty("database_name", "string", "The name of the database.").to_dict(),
-    ToolProperty("container_name", "string", "The name of the container.").to_dict(),
-    ToolProperty("item_id", "string", "The ID of the item to delete.").to_dict(),
-    ToolProperty("partition_key", "string", "The partition key value for the item.").to_dict(),
+delete_item_properties = _dumps([
+    {"propertyName": "database_name", "propertyType": "string", "description": "The name of the database."},
+    {"propertyName": "container_name", "propertyType": "string", "description": "The name of the container."},
+    {"propertyName": "item_id", "propertyType": "string", "description": "The ID of the item to delete."},
+    {"propertyName": "partition_key", "propertyType": "string", "description": "The partition key value for the item."},
 ])
 
-upsert_item_properties = json.dumps([
-    ToolProperty("database_name", "string", "The name of the database.").to_dict(),
-    ToolProperty("container_name", "string", "The name of the container.").to_dict(),
-    ToolProperty("item", "string", "The JSON string representing the item to upsert (insert or update).").to_dict(),
+upsert_item_properties = _dumps([
+    {"propertyName": "database_name", "propertyType": "string", "description": "The name of the database."},
+    {"propertyName": "container_name", "propertyType": "string", "description": "The name of the container."},
+    {"propertyName": "item", "propertyType": "string", "description": "The JSON string representing the item to upsert (insert or update)."},
+    {"propertyName": "return_body", "propertyType": "boolean", "description": "Optional. Set to true to include the stored item in the response. Defaults to false."},
 ])
 
 
@@ -84,21 +174,21 @@ upsert_item_properties = json.dumps([
     description="List all databases in the CosmosDB account.",
     toolProperties=list_databases_properties,
 )
-def list_databases(context) -> str:
+async def list_databases(context) -> str:
     """List all databases in the CosmosDB account."""
     try:
         client = get_cosmos_client()
-        databases = list(client.list_databases())
+        databases = [db async for db in client.list_databases()]
         database_names = [db['id'] for db in databases]
         logging.info(f"Listed {len(database_names)} databases")
-        return json.dumps({
+        return _dumps({
             "success": True,
             "databases": database_names,
             "count": len(database_names)
         })
     except Exception as e:
         logging.error(f"Error listing databases: {str(e)}")
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})
 
 
 # MCP Tool: List containers in a database
@@ -109,29 +199,29 @@ def list_databases(context) -> str:
     description="List all containers in a specific CosmosDB database.",
     toolProperties=list_containers_properties,
 )
-def list_containers(context) -> str:
+async def list_containers(context) -> str:
     """List all containers in a specific database."""
     try:
-        content = json.loads(context)
+        content = orjson.loads(context)
         database_name = content["arguments"]["database_name"]
         
         client = get_cosmos_client()
         database = client.get_database_client(database_name)
-        containers = list(database.list_containers())
+        containers = [c async for c in database.list_containers()]
         container_names = [c['id'] for c in containers]
         
         logging.info(f"Listed {len(container_names)} containers in database '{database_name}'")
-        return json.dumps({
+        return _dumps({
             "success": True,
             "database": database_name,
             "containers": container_names,
             "count": len(container_names)
         })
     except exceptions.CosmosResourceNotFoundError:
-        return json.dumps({"success": False, "error": f"Database '{database_name}' not found"})
+        return _dumps({"success": False, "error": f"Database '{database_name}' not found"})
     except Exception as e:
         logging.error(f"Error listing containers: {str(e)}")
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})
 
 
 # MCP Tool: Query items in a container
@@ -139,43 +229,84 @@ def list_containers(context) -> str:
     arg_name="context",
     type="mcpToolTrigger",
     toolName="query_items",
-    description="Execute a SQL query against a CosmosDB container to retrieve items.",
+    description="Execute a SQL query against a CosmosDB container to retrieve items. Simple queries return one page of results with has_more and continuation_token; if has_more is true, call again with that continuation_token to fetch the next page. Queries using ORDER BY, DISTINCT, GROUP BY, TOP, OFFSET/LIMIT or aggregate functions cannot be resumed: they return at most max_items items and no continuation_token, with truncated set to true if more results exist.",
     toolProperties=query_items_properties,
 )
-def query_items(context) -> str:
+async def query_items(context) -> str:
     """Execute a SQL query against a container."""
     try:
-        content = json.loads(context)
+        content = orjson.loads(context)
         database_name = content["arguments"]["database_name"]
         container_name = content["arguments"]["container_name"]
         query = content["arguments"]["query"]
+        continuation_token = content["arguments"].get("continuation_token") or None
+        max_items = content["arguments"].get("max_items")
+        if max_items is None or max_items == "":
+            max_items = QUERY_PAGE_SIZE
+        else:
+            try:
+                max_items = int(float(max_items))
+            except (TypeError, ValueError, OverflowError):
+                return _dumps({"success": False, "error": "max_items must be an integer"})
+        max_items = max(1, min(max_items, QUERY_PAGE_SIZE))
         
-        client = get_cosmos_client()
-        database = client.get_database_client(database_name)
-        container = database.get_container_client(container_name)
+        pipelined = _is_pipelined_query(query)
+        if pipelined and continuation_token:
+            return _dumps({
+                "success": False,
+                "error": "continuation_token is not supported for queries using ORDER BY, DISTINCT, GROUP BY, TOP, OFFSET/LIMIT or aggregate functions; add a filter to narrow the results instead"
+            })
+        
+        container = get_container_client(database_name, container_name)
         
-        # Execute query with cross-partition enabled
-        items = list(container.query_items(
-            query=query,
-            enable_cross_partition_query=True
-        ))
+        # The async client fans out across partitions whenever no partition key is given.
+        # At most max_items are read per call, so the result set is never fully buffered in memory.
+        items = []
+        truncated = False
+        if pipelined:
+            # Read up to the cap, plus one item to tell whether the result was cut short. The page
+            # size includes that extra item so it arrives with the first page, not a second one.
+            async for item in container.query_items(query=query, max_item_count=max_items + 1):
+                if len(items) == max_items:
+                    truncated = True
+                    break
+                items.append(item)
+        else:
+            pager = container.query_items(
+                query=query,
+                max_item_count=max_items
+            ).by_page(continuation_token)
+            # An exhausted resume raises before the pager updates its token, leaving the caller's
+            # own token in place, so only trust the token when a page was actually read
+            next_token = None
+            async for page in pager:
+                items = [item async for item in page]
+                next_token = pager.continuation_token
+                break
         
         logging.info(f"Query returned {len(items)} items from '{database_name}/{container_name}'")
-        return json.dumps({
+        result = {
             "success": True,
             "database": database_name,
             "container": container_name,
             "query": query,
             "items": items,
             "count": len(items)
-        })
+        }
+        if pipelined:
+            result["truncated"] = truncated
+        else:
+            # Only tokens from non-pipelined queries are resumable, so only they are reported
+            result["has_more"] = next_token is not None
+            result["continuation_token"] = next_token
+        return _dumps(result)
     except exceptions.CosmosResourceNotFoundError as e:
-        return json.dumps({"success": False, "error": f"Resource not found: {str(e)}"})
+        return _dumps({"success": False, "error": f"Resource not found: {str(e)}"})
     except exceptions.CosmosHttpResponseError as e:
-        return json.dumps({"success": False, "error": f"Query error: {str(e)}"})
+        return _dumps({"success": False, "error": f"Query error: {str(e)}"})
     except Exception as e:
         logging.error(f"Error querying items: {str(e)}")
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})
 
 
 # MCP Tool: Get a single item by ID
@@ -186,31 +317,29 @@ def query_items(context) -> str:
     description="Retrieve a single item from a CosmosDB container by its ID and partition key.",
     toolProperties=get_item_properties,
 )
-def get_item(context) -> str:
+async def get_item(context) -> str:
     """Get a single item by ID and partition key."""
     try:
-        content = json.loads(context)
+        content = orjson.loads(context)
         database_name = content["arguments"]["database_name"]
         container_name = content["arguments"]["container_name"]
         item_id = content["arguments"]["item_id"]
         partition_key = content["arguments"]["partition_key"]
         
-        client = get_cosmos_client()
-        database = client.get_database_client(database_name)
-        container = database.get_container_client(container_name)
+        container = get_container_client(database_name, container_name)
         
-        item = container.read_item(item=item_id, partition_key=partition_key)
+        item = await container.read_item(item=item_id, partition_key=partition_key)
         
         logging.info(f"Retrieved item '{item_id}' from '{database_name}/{container_name}'")
-        return json.dumps({
+        return _dumps({
             "success": True,
             "item": item
         })
     except exceptions.CosmosResourceNotFoundError:
-        return json.dumps({"success": False, "error": f"Item '{item_id}' not found"})
+        return _dumps({"success": False, "error": f"Item '{item_id}' not found"})
     except Exception as e:
         logging.error(f"Error getting item: {str(e)}")
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})
 
 
 # MCP Tool: Delete an item
@@ -221,31 +350,29 @@ def get_item(context) -> str:
     description="Delete an item from a CosmosDB container by its ID and partition key.",
     toolProperties=delete_item_properties,
 )
-def delete_item(context) -> str:
+async def delete_item(context) -> str:
     """Delete an item from a container."""
     try:
-        content = json.loads(context)
+        content = orjson.loads(context)
         database_name = content["arguments"]["database_name"]
         container_name = content["arguments"]["container_name"]
         item_id = content["arguments"]["item_id"]
         partition_key = content["arguments"]["partition_key"]
         
-        client = get_cosmos_client()
-        database = client.get_database_client(database_name)
-        container = database.get_container_client(container_name)
+        container = get_container_client(database_name, container_name)
         
-        container.delete_item(item=item_id, partition_key=partition_key)
+        await container.delete_item(item=item_id, partition_key=partition_key)
         
         logging.info(f"Deleted item '{item_id}' from '{database_name}/{container_name}'")
-        return json.dumps({
+        return _dumps({
             "success": True,
             "message": f"Item '{item_id}' deleted successfully"
         })
     except exceptions.CosmosResourceNotFoundError:
-        return json.dumps({"success": False, "error": f"Item '{item_id}' not found"})
+        return _dumps({"success": False, "error": f"Item '{item_id}' not found"})
     except Exception as e:
         logging.error(f"Error deleting item: {str(e)}")
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})
 
 
 # MCP Tool: Upsert an item (insert or update)
@@ -256,31 +383,33 @@ def delete_item(context) -> str:
     description="Update or insert an item in a CosmosDB container. Use this to update an existing item or create a new one. If an item with the same ID exists, it will be replaced with the new data; otherwise, a new item will be created.",
     toolProperties=upsert_item_properties,
 )
-def upsert_item(context) -> str:
+async def upsert_item(context) -> str:
     """Upsert an item in a container (insert or replace if exists)."""
     try:
-        content = json.loads(context)
+        content = orjson.loads(context)
         database_name = content["arguments"]["database_name"]
         container_name = content["arguments"]["container_name"]
         item_str = content["arguments"]["item"]
+        return_body = str(content["arguments"].get("return_body", False)).lower() == "true"
         
         # Parse the item JSON string
-        item = json.loads(item_str)
+        item = orjson.loads(item_str)
         
-        client = get_cosmos_client()
-        database = client.get_database_client(database_name)
-        container = database.get_container_client(container_name)
+        container = get_container_client(database_name, container_name)
         
-        upserted_item = container.upsert_item(body=item)
+        # Skip the response payload unless the caller asked for it; it echoes the item just sent
+        upserted_item = await container.upsert_item(body=item, no_response=not return_body)
         
         logging.info(f"Upserted item in '{database_name}/{container_name}'")
-        return json.dumps({
+        result = {
             "success": True,
-            "message": "Item upserted successfully (inserted or updated)",
-            "item": upserted_item
-        })
-    except json.JSONDecodeError:
-        return json.dumps({"success": False, "error": "Invalid JSON format for item"})
+            "message": "Item upserted successfully (inserted or updated)"
+        }
+        if return_body:
+            result["item"] = upserted_item
+        return _dumps(result)
+    except orjson.JSONDecodeError:
+        return _dumps({"success": False, "error": "Invalid JSON format for item"})
     except Exception as e:
         logging.error(f"Error upserting item: {str(e)}")
-        return json.dumps({"success": False, "error": str(e)})
+        return _dumps({"success": False, "error": str(e)})